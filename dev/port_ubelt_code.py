@@ -38,17 +38,15 @@ def autogen_mkint_utils():
     lib.expand(['ubelt'])
     text = lib.current_sourcecode()
     print(text)
-    """
-    pip install rope
-    pip install parso
-    """
-    import parso
+    import ast
     import mkinit
     target_fpath = ub.Path(mkinit.util.util_import.__file__)
-    new_module = parso.parse(text)
-    old_module = parso.parse(target_fpath.read_text())
-    new_names = [child.name.value for child in new_module.children if child.type in {'funcdef', 'classdef'}]
-    old_names = [child.name.value for child in old_module.children if child.type in {'funcdef', 'classdef'}]
+    def_types = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+    new_tree = ast.parse(text)
+    with open(target_fpath, 'r') as file:
+        old_tree = ast.parse(file.read())
+    new_names = [node.name for node in new_tree.body if isinstance(node, def_types)]
+    old_names = [node.name for node in old_tree.body if isinstance(node, def_types)]
     print(set(old_names) - set(new_names))
     print(set(new_names) - set(old_names))
     text = postprocess_ported_code(text)
@@ -2,14 +2,39 @@
 Contains logic for formatting statically / dynamically extracted information
 into the final product.
 """
-from os.path import join, exists
+from os.path import join
+from bisect import bisect_left
+from functools import lru_cache
+from itertools import accumulate
+import io
 import textwrap
 import logging
+import re
 from mkinit import static_analysis as static
 
 
 logger = logging.getLogger(__name__)
 
+# Lines that are respected (not clobbered) when explicit tags are not given
+_IMPLICIT_RE = re.compile(
+    r"^\s*(?:from __future__|__version__|__submodules__|__external__"
+    r"|__private__|__protected__|#|\"\"\"|''')"
+)
+_AUTOGEN_START_RE = re.compile(r"^\s*# <AUTOGEN_INIT>")
+_AUTOGEN_END_RE = re.compile(r"^\s*# </AUTOGEN_INIT>")
+
+
+_DEFAULT_OPTIONS = {
+    "with_attrs": True,
+    "with_mods": True,
+    "with_all": True,
+    "relative": False,
+    "lazy_import": False,
+    "lazy_loader": False,
+    "lazy_boilerplate": None,
+    "use_black": False,
+}
+
 
 def _ensure_options(given_options=None):
     """
@@ -26,26 +51,38 @@ def _ensure_options(given_options=None):
             (Default: False)
 
     """
+    options = _DEFAULT_OPTIONS.copy()
     if given_options is None:
-        given_options = {}
-    default_options = {
-        "with_attrs": True,
-        "with_mods": True,
-        "with_all": True,
-        "relative": False,
-        "lazy_import": False,
-        "lazy_loader": False,
-        "lazy_boilerplate": None,
-        "use_black": False,
-    }
-    options = default_options.copy()
+        return options
     for k in given_options.keys():
-        if k not in default_options:
+        if k not in _DEFAULT_OPTIONS:
             raise KeyError("options got bad key={}".format(k))
     options.update(given_options)
     return options
 
 
+@lru_cache(maxsize=None)
+def _get_black():
+    """
+    Returns the black module or None if it is not installed.
+
+    black is optional and slow to import, so it is only loaded on first use.
+    """
+    try:
+        import black
+    except ImportError:
+        return None
+    return black
+
+
+@lru_cache(maxsize=None)
+def _black_mode(string_normalization=True):
+    """
+    Returns a shared black.Mode so it is only constructed once per setting.
+    """
+    return _get_black().Mode(string_normalization=string_normalization)
+
+
 def _insert_autogen_text(modpath, initstr):
     """
     Creates new text for `__init__.py` containing the autogenerated code.
@@ -59,11 +96,14 @@ def _insert_autogen_text(modpath, initstr):
     init_fpath = join(modpath, "__init__.py")
     logger.debug("inserting initstr into: {!r}".format(init_fpath))
 
-    if exists(init_fpath):
+    try:
         with open(init_fpath, "r") as file_:
-            lines = file_.readlines()
-    else:
-        lines = []
+            data = file_.read()
+    except FileNotFoundError:
+        data = ""
+    # Only split on newlines; str.splitlines also breaks on characters like
+    # form feeds and U+2028 that can appear inside strings and comments
+    lines = io.StringIO(data).readlines()
 
     startline, endline, init_indent = _find_insert_points(lines)
     initstr_ = _indent(initstr, init_indent) + "\n"
@@ -72,9 +112,13 @@ def _insert_autogen_text(modpath, initstr):
     if QUICKFIX_REMOVE_LEADING_NEWLINES:
         initstr_ = initstr_.lstrip('\n')
 
-    new_lines = lines[:startline] + [initstr_] + lines[endline:]
+    # Splice the new text in by character offset rather than by rebuilding
+    # the list of lines
+    line_offsets = [0] + list(accumulate(map(len, lines)))
+    start_off = line_offsets[startline]
+    end_off = line_offsets[endline]
 
-    new_text = "".join(new_lines).rstrip() + "\n"
+    new_text = (data[:start_off] + initstr_ + data[end_off:]).rstrip() + "\n"
     print(new_text)
     return init_fpath, new_text
 
@@ -140,16 +184,35 @@ def _find_insert_points(lines):
     # print = logging.debug
     print('Searching for points to insert autogenerated code')
 
+    # Check explicit modes first. If the tags exist they take precedence and
+    # we can skip the expensive parsing needed by the implicit patterns.
+    for lineno, line in enumerate(lines):
+        if _AUTOGEN_START_RE.match(line):  # allow tags too
+            print('[mkinit] FOUND START TAG ON LINE {}: {}'.format(lineno, line))
+            init_indent = line[: line.find("#")]
+            explicit_flag = True
+            startline = lineno + 1
+        if explicit_flag and _AUTOGEN_END_RE.match(line):
+            print('[mkinit] FOUND END TAG ON LINE {}: {}'.format(lineno, line))
+            endline = lineno
+
+    if explicit_flag:
+        assert startline <= endline
+        return startline, endline, init_indent
+
+    if not any(_IMPLICIT_RE.match(line) for line in lines):
+        # Nothing to respect, so all text is clobbered
+        return startline, endline, init_indent
+
     # co-opt the xdoctest parser to break appart lines in the init file
     # This lets us correctly skip to the end of a multiline expression
     # A better solution might be to use the line-number aware parser
     # to search for AUTOGEN_INIT comments and other relevant structures.
     source_lines = [">>> " + p.rstrip("\n") for p in lines]
-    try:
+    if source_lines:
         ps1_lines, _ = static._locate_ps1_linenos(source_lines)
         print('ps1_lines = {!r}'.format(ps1_lines))
-    except IndexError:
-        assert len(lines) == 0
+    else:
         ps1_lines = []
 
     # Algorithm is similar to the old version, but we skip to the next PS1
@@ -157,66 +220,35 @@ def _find_insert_points(lines):
 
     skipto = None
 
-    def _tryskip(lineno):
-        """ returns the next line to skip to if possible """
-
-    implicit_patterns = (
-        "from __future__",
-        "__version__",
-        "__submodules__",
-        "__external__",
-        "__private__",
-        "__protected__",
-        "#",
-        '"""',
-        "'''",
-    )
     for lineno, line in enumerate(lines):
-
-        # Check explicit modes regardless of skipping
-        if line.strip().startswith("# <AUTOGEN_INIT>"):  # allow tags too
-            print('[mkinit] FOUND START TAG ON LINE {}: {}'.format(lineno, line))
-            init_indent = line[: line.find("#")]
-            explicit_flag = True
+        if skipto is not None:
+            if lineno != skipto:
+                continue
+            else:
+                print('SKIPPED TO = {!r}'.format(lineno))
+                skipto = None
+        # ps1_lines is sorted, so we can find this line by bisection
+        idx = bisect_left(ps1_lines, lineno)
+        on_ps1 = idx < len(ps1_lines) and ps1_lines[idx] == lineno
+        has_next = idx + 1 < len(ps1_lines)
+        if _IMPLICIT_RE.match(line):
+            print('[mkinit] RESPECTING LINE {}: {}'.format(lineno, line.rstrip('\n')))
             startline = lineno + 1
-        if explicit_flag and line.strip().startswith("# </AUTOGEN_INIT>"):
-            print('[mkinit] FOUND END TAG ON LINE {}: {}'.format(lineno, line))
-            endline = lineno
-
-        if not explicit_flag:
-            if skipto is not None:
-                if lineno != skipto:
-                    continue
-                else:
-                    print('SKIPPED TO = {!r}'.format(lineno))
-                    skipto = None
-            if line.strip().startswith(implicit_patterns):
-                print('[mkinit] RESPECTING LINE {}: {}'.format(lineno, line.rstrip('\n')))
-                startline = lineno + 1
-                try:
-                    # Try and skip to the end of the expression
-                    # (if it is a multiline case)
-                    idx = ps1_lines.index(lineno)
-                    skipto = ps1_lines[idx + 1]
-                    startline = skipto
-                    print('SKIPTO = {!r}'.format(skipto))
-                except ValueError:
-                    print('NOT ON A PS1 LINE KEEP {}'.format(startline))
-                except IndexError:
-                    print('LAST LINE MOVING TO END {}'.format(startline))
-                    startline = endline
+            # Try and skip to the end of the expression
+            # (if it is a multiline case)
+            if not on_ps1:
+                print('NOT ON A PS1 LINE KEEP {}'.format(startline))
+            elif has_next:
+                skipto = ps1_lines[idx + 1]
+                startline = skipto
+                print('SKIPTO = {!r}'.format(skipto))
             else:
-                # Even if we dont respect the lines, try not to end between
-                # PS1 lines.
-                try:
-                    # Try and skip to the end of the expression
-                    # (if it is a multiline case)
-                    idx = ps1_lines.index(lineno)
-                    skipto = ps1_lines[idx + 1]
-                except ValueError:
-                    ...
-                except IndexError:
-                    ...
+                print('LAST LINE MOVING TO END {}'.format(startline))
+                startline = endline
+        elif on_ps1 and has_next:
+            # Even if we dont respect the lines, try not to end between
+            # PS1 lines.
+            skipto = ps1_lines[idx + 1]
 
     # print('startline = {}'.format(startline))
     # print('endline = {}'.format(endline))
@@ -225,10 +257,11 @@ def _find_insert_points(lines):
 
 
 def _indent(text, indent="    "):
-    new_text = indent + text.replace("\n", "\n" + indent)
     # remove whitespace on blank lines
-    new_text = "\n".join([line.rstrip() for line in new_text.split("\n")])
-    return new_text
+    return "\n".join(
+        indent + line.rstrip() if line.strip() else ""
+        for line in text.split("\n")
+    )
 
 
 def _initstr(
@@ -350,7 +383,8 @@ def _initstr(
     exposed_submodules.update(protected_submodules)
     exposed_all.update(protected_submodules)
 
-    from fnmatch import fnmatch
+    from fnmatch import translate
+    from os.path import normcase
 
     # TODO: allow pattern matching here
     # step1: separate into explicit vs glob-pattern strings
@@ -363,27 +397,31 @@ def _initstr(
     _pp_pats = protected_pats | private_pats
     _pp_set = private_set | protected_set
 
-    def _private_matches(x):
-        x = x.lstrip(".")
-        return x in private_set or any(fnmatch(x, pat) for pat in private_pats)
-
-    def _pp_matches(x):
-        # TODO: standardize how explicit vs submodules are handled
-        x = x.lstrip(".")
-        return x in _pp_set or any(fnmatch(x, pat) for pat in _pp_pats)
-
-    raw_from_imports = [(m, sub) for m, sub in from_imports if not _pp_matches(m)]
-
-    if options.get("with_attrs", True):
-        exposed_from_imports = raw_from_imports
-    elif protected:
-        exposed_from_imports = [
-            (m, set(sub) & protected) for m, sub in raw_from_imports
-        ]
-    exposed_from_imports = [(m, sub) for m, sub in exposed_from_imports if sub]
-    exposed_all.update(
-        {n for m, sub in exposed_from_imports for n in sub if not _private_matches(n)}
-    )
+    # Translate each glob only once instead of on every fnmatch call. Like
+    # fnmatch, names and patterns are compared after os.path.normcase.
+    _private_res = [re.compile(translate(normcase(pat))) for pat in private_pats]
+    _pp_res = [re.compile(translate(normcase(pat))) for pat in _pp_pats]
+
+    # Filter and collect the exposed names in a single pass
+    # TODO: standardize how explicit vs submodules are handled
+    with_attrs = options.get("with_attrs", True)
+    for m, sub in from_imports:
+        lm = m.lstrip(".")
+        if lm in _pp_set or any(r.match(normcase(lm)) for r in _pp_res):
+            continue
+        if not with_attrs:
+            if not protected:
+                continue
+            sub = set(sub) & protected
+        if not sub:
+            continue
+        exposed_from_imports.append((m, sub))
+        for n in sub:
+            ns = n.lstrip(".")
+            if ns in private_set:
+                continue
+            if not any(r.match(normcase(ns)) for r in _private_res):
+                exposed_all.add(n)
     exposed_all.update(explicit)
 
     exposed_all = sorted(exposed_all)
@@ -424,19 +462,10 @@ def _initstr(
         else:
             submodules = set()
 
-        # Currently this is the only use of ubelt, but repr2
-        # is easier to use in testing than pprint, so perhaps
-        # we can remove complexity and just use ubelt elsewhere
-        import ubelt as ub
-
-        # exposed_submodules = set(exposed_submodules)
-        submodules_repr = ub.repr2(exposed_submodules).replace("\n", "\n    ")
-        # hack for python <3.7 tests
-        submodules_repr = submodules_repr.replace('[', '{').replace(']', '}')
-
+        submodules_repr = _repr_nested(set(exposed_submodules))
         initstr = template.format(
-            submodules=submodules_repr,
-            submod_attrs=ub.repr2(submod_attrs).replace("\n", "\n    "),
+            submodules=submodules_repr.replace("\n", "\n    "),
+            submod_attrs=_repr_nested(submod_attrs).replace("\n", "\n    "),
         )
 
         # print("options = {!r}".format(options))
@@ -513,19 +542,10 @@ def _initstr(
         else:
             submodules = set()
 
-        # Currently this is the only use of ubelt, but repr2
-        # is easier to use in testing than pprint, so perhaps
-        # we can remove complexity and just use ubelt elsewhere
-        import ubelt as ub
-
-        # exposed_submodules = set(exposed_submodules)
-        submodules_repr = ub.repr2(exposed_submodules).replace("\n", "\n    ")
-        # hack for python <3.7 tests
-        submodules_repr = submodules_repr.replace('[', '{').replace(']', '}')
-
+        submodules_repr = _repr_nested(set(exposed_submodules))
         initstr = template.format(
-            submodules=submodules_repr,
-            submod_attrs=ub.repr2(submod_attrs).replace("\n", "\n    "),
+            submodules=submodules_repr.replace("\n", "\n    "),
+            submod_attrs=_repr_nested(submod_attrs).replace("\n", "\n    "),
         )
 
         if options["lazy_boilerplate"] is None:
@@ -554,39 +574,70 @@ def _initstr(
                 """
                 ).rstrip()
             )
-        exports_repr = ["'{}'".format(e) for e in sorted(exposed_all)]
-        rhs_body = ", ".join(exports_repr)
+        # exposed_all is already sorted
+        rhs_body = ", ".join(map(repr, exposed_all))
         packed = _packed_rhs_text("__all__ = [", rhs_body + "]")
         append_part(packed)
 
     initstr = "\n".join([p for p in parts])
 
     if options["use_black"]:
-        try:
-            import black
-
-            initstr = black.format_str(
-                initstr, mode=black.Mode(string_normalization=True)
-            )
-        except ImportError:
-            pass
+        black = _get_black()
+        if black is not None:
+            initstr = black.format_str(initstr, mode=_black_mode(True))
     return initstr
 
 
-def _make_imports_str(imports, rootmodname="."):
-    if False:
-        imports_fmtstr = "from {rootmodname} import %s".format(rootmodname=rootmodname)
-        return "\n".join([imports_fmtstr % (name,) for name in imports])
+def _repr_nested(data, indent="    "):
+    """
+    Formats nested containers with one item per line and trailing commas.
+
+    Dictionary keys and sets are sorted so the generated code is stable.
+
+    Example:
+        >>> print(_repr_nested({'b': ['y', 'x'], 'a': {'z', 'w'}, 'c': []}))
+        {
+            'a': {
+                'w',
+                'z',
+            },
+            'b': [
+                'y',
+                'x',
+            ],
+            'c': [],
+        }
+    """
+    if isinstance(data, dict):
+        items = [
+            "{!r}: {}".format(key, _repr_nested(data[key], indent))
+            for key in sorted(data)
+        ]
+        open_, close = "{", "}"
+    elif isinstance(data, (set, frozenset)):
+        items = [_repr_nested(item, indent) for item in sorted(data)]
+        open_, close = "{", "}"
+    elif isinstance(data, (list, tuple)):
+        items = [_repr_nested(item, indent) for item in data]
+        open_, close = ("[", "]") if isinstance(data, list) else ("(", ")")
     else:
-        imports_fmtstr = "from {rootmodname} import %s".format(rootmodname=rootmodname)
-        return "\n".join(
-            [
-                imports_fmtstr % (name.lstrip("."))
-                if name.startswith(".")
-                else "import %s" % (name,)
-                for name in imports
-            ]
-        )
+        return repr(data)
+    if not items:
+        return open_ + close
+    body = "".join(
+        indent + item.replace("\n", "\n" + indent) + ",\n" for item in items
+    )
+    return open_ + "\n" + body + close
+
+
+def _make_imports_str(imports, rootmodname="."):
+    prefix = f"from {rootmodname} import "
+    return "\n".join(
+        [
+            prefix + name.lstrip(".") if name.startswith(".") else f"import {name}"
+            for name in imports
+        ]
+    )
 
 
 def _packed_rhs_text(lhs_text, rhs_text):
@@ -627,16 +678,10 @@ def _packed_rhs_text(lhs_text, rhs_text):
 
     if 0:
         # options['use_black']:
-        import black
-
         raw_text = lhs_text + rhs_text
-        packstr = black.format_str(
-            raw_text, mode=black.Mode(string_normalization=False)
-        )
+        packstr = _get_black().format_str(raw_text, mode=_black_mode(False))
         return packstr
     else:
-        import re
-
         # not sure why this isn't 76? >= maybe?
         max_width = 79
 
@@ -646,30 +691,22 @@ def _packed_rhs_text(lhs_text, rhs_text):
         else:
             newline_prefix = " " * len(lhs_text)
 
-        raw_text = lhs_text + rhs_text
-        wrapped_lines = textwrap.wrap(
-            raw_text,
-            break_long_words=False,
-            width=79,
-            initial_indent="",
-            subsequent_indent=newline_prefix,
-        )
-        packstr = "\n".join(wrapped_lines)
-
-        FIX_FORMAT = 1
-        if FIX_FORMAT:
-            regex = r"\s*".join(list(map(re.escape, lhs_text.split(" "))))
-            assert re.match(regex, lhs_text)
-            match = re.search(regex, packstr)
-            span = match.span()
-            assert span[0] == 0
-            wrapped_lhs = match.string[: span[1]]
-
-            # If textwrap broke the LHS then do something slightly different
-            if "\n" in wrapped_lhs:
-                new_rhs = packstr[span[1] :]
-                new_packstr = lhs_text + "\n" + newline_prefix + new_rhs
-                packstr = new_packstr
+        # Greedily pack the space separated rhs items. The first item is
+        # attached directly to the lhs, which is never broken.
+        items = rhs_text.split(" ")
+        line = lhs_text + items[0]
+        lines = []
+        if len(line) > max_width:
+            lines.append(lhs_text)
+            line = newline_prefix + items[0]
+        for item in items[1:]:
+            if len(line) + 1 + len(item) <= max_width:
+                line += " " + item
+            else:
+                lines.append(line)
+                line = newline_prefix + item
+        lines.append(line)
+        packstr = "\n".join(lines)
 
     return packstr
 
@@ -708,7 +745,7 @@ def _make_fromimport_str(from_imports, rootmodname=".", indent=""):
             normname = name
 
         if len(fromlist) > 0:
-            lhs_text = indent + "from {normname} import (".format(normname=normname)
+            lhs_text = f"{indent}from {normname} import ("
             rhs_text = ", ".join(fromlist) + ",)"
             packstr = _packed_rhs_text(lhs_text, rhs_text)
         else:
@@ -1,6 +1,7 @@
 """
 Static version of dynamic_autogen.py
 """
+import io
 import os
 from mkinit import static_analysis as static
 from mkinit.util import util_import
@@ -172,9 +173,11 @@ def static_init(modpath_or_name, submodules=None, respect_all=True, options=None
         init_fpath = join(modpath, "__init__.py")
         if exists(init_fpath):
             with open(init_fpath, "r") as file_:
-                lines = file_.readlines()
+                data = file_.read()
         else:
-            lines = []
+            data = ""
+        # Only split on newlines (str.splitlines also splits on U+2028, etc)
+        lines = io.StringIO(data).readlines()
         startline, endline, init_indent = _find_insert_points(lines)
         user_text = ''.join(lines[:startline] + lines[endline:])
 
@@ -1,5 +1,6 @@
 from xdoctest import utils
 from mkinit.formatting import _find_insert_points
+from mkinit.formatting import _packed_rhs_text
 
 
 def test_explicit_insert_points():
@@ -33,6 +34,13 @@ def test_implicit_version_insert_points():
     assert (start, end, indent) == (1, 1, "")
 
 
+def test_implicit_form_feed_insert_points():
+    # Form feeds are valid leading whitespace in Python source
+    lines = ["\x0c__version__ = '1.0'\n", "x = 1\n"]
+    start, end, indent = _find_insert_points(lines)
+    assert (start, end, indent) == (1, 2, "")
+
+
 def test_implicit_future_insert_points():
     lines = utils.codeblock(
         """
@@ -84,3 +92,51 @@ def test_implicit_stacked_insert_points():
     ).split("\n")
     start, end, indent = _find_insert_points(lines)
     assert (start, end, indent) == (4, 5, "")
+
+
+def test_no_markers_insert_points():
+    lines = utils.codeblock(
+        """
+        clobbered1 = (
+            True)
+        clobbered2 = True
+        """
+    ).split("\n")
+    start, end, indent = _find_insert_points(lines)
+    assert (start, end, indent) == (0, 3, "")
+
+
+def test_packed_rhs_aligned_continuation():
+    lhs_text = "from foo.bar import ("
+    rhs_text = ", ".join("func{}".format(i) for i in range(12)) + ",)"
+    packstr = _packed_rhs_text(lhs_text, rhs_text)
+    assert packstr == utils.codeblock(
+        """
+        from foo.bar import (func0, func1, func2, func3, func4, func5, func6, func7,
+                             func8, func9, func10, func11,)
+        """
+    )
+
+
+def test_packed_rhs_long_lhs():
+    # Long lhs texts use a fixed four space continuation indent
+    lhs_text = " " * 8 + "from " + "a" * 49 + " import ("
+    rhs_text = ", ".join("func{}".format(i) for i in range(12)) + ",)"
+    packstr = _packed_rhs_text(lhs_text, rhs_text)
+    assert packstr == "\n".join([
+        lhs_text + "func0,",
+        "    func1, func2, func3, func4, func5, func6, func7, func8, func9, func10,",
+        "    func11,)",
+    ])
+
+    # If the first item does not fit, the lhs is kept on its own line and the
+    # continuation lines are packed to the full width
+    lhs_text = " " * 8 + "from " + "a" * 53 + " import ("
+    rhs_text = ", ".join("function_number_{}".format(i) for i in range(8)) + ",)"
+    packstr = _packed_rhs_text(lhs_text, rhs_text)
+    assert packstr == "\n".join([
+        lhs_text,
+        "    function_number_0, function_number_1, function_number_2, function_number_3,",
+        "    function_number_4, function_number_5, function_number_6,",
+        "    function_number_7,)",
+    ])
@@ -98,3 +98,17 @@ def test_simple_lazy_import():
     #     info = ub.cmd('tree ' + dpath, tee=1)
     #     info = ub.cmd('cat ' + paths['subpkg_init'], tee=1)
     #     info = ub.cmd('cat ' + paths['root_init'], tee=1)
+
+
+def test_simple_unicode_line_separator():
+    """
+    Only newlines separate the lines of the existing init text, so other
+    unicode line separators and form feeds are preserved.
+    """
+    import mkinit
+    paths = make_simple_dummy_package()
+    with open(paths["root_init"], "w") as file:
+        file.write("__version__ = '1.0'\nNOTE = 'a\u2028b'\n# c\x0cd\n")
+    init_fpath, new_text = mkinit.autogen_init(paths["root"], dry=True)
+    assert "NOTE = 'a\u2028b'\n# c\x0cd\n" in new_text
+    assert "from mkinit_demo_pkg import submod" in new_text